@@ -15,6 +15,22 @@ from utils import my_softmax, get_offdiag_indices, gumbel_softmax
 _EPS = 1e-10
 
 
+def node2edge_gather(x, rel):
+    # rel is either a dense [num_edges, num_nodes] one-hot matrix or the
+    # [num_edges] vector of node indices of every edge
+    if rel.dim() == 1:
+        return x.index_select(-2, rel)
+    return torch.matmul(rel, x)
+
+
+def edge2node_scatter(x, rel, num_nodes):
+    # sums the edge features of x into their nodes, see node2edge_gather
+    if rel.dim() == 1:
+        out = x.new_zeros(x.shape[:-2] + (num_nodes, x.size(-1)))
+        return out.index_add_(x.dim() - 2, rel, x)
+    return torch.matmul(rel.t(), x)
+
+
 class MLP(nn.Module):
     """Two-layer fully-connected ELU net with batch norm."""
 
@@ -195,15 +211,15 @@ class MLPEncoder_multi(nn.Module):
                 if not math.isclose(self.bias_init, 0, rel_tol=1e-9):
                     m.bias.data.fill_(self.bias_init)
 
-    def edge2node(self, x, rel_rec, rel_send):
+    def edge2node(self, x, rel_rec, rel_send, num_nodes):
         # NOTE: Assumes that we have the same graph across all samples.
-        incoming = torch.matmul(rel_rec.t(), x)
+        incoming = edge2node_scatter(x, rel_rec, num_nodes)
         return incoming / incoming.size(1)
 
     def node2edge(self, x, rel_rec, rel_send):
         # NOTE: Assumes that we have the same graph across all samples.
-        receivers = torch.matmul(rel_rec, x)
-        senders = torch.matmul(rel_send, x)
+        receivers = node2edge_gather(x, rel_rec)
+        senders = node2edge_gather(x, rel_send)
         edges = torch.cat([receivers, senders], dim=2)
         return edges
 
@@ -218,7 +234,7 @@ class MLPEncoder_multi(nn.Module):
         x = self.mlp2(x)
         x_skip = x
 
-        x = self.edge2node(x, rel_rec, rel_send)
+        x = self.edge2node(x, rel_rec, rel_send, inputs.size(1))
         if self.split_point == 0:
             x = self.mlp3(x)
             x = self.node2edge(x, rel_rec, rel_send)
@@ -466,8 +482,8 @@ class RNNDecoder_multi(nn.Module):
     def step(self, inputs, hidden, rel_rec, rel_send, rel_type, clinical_data):
 
         # node2edge
-        receivers = torch.matmul(rel_rec, hidden)
-        senders = torch.matmul(rel_send, hidden)
+        receivers = node2edge_gather(hidden, rel_rec)
+        senders = node2edge_gather(hidden, rel_send)
         pre_msg = torch.cat([receivers, senders], dim=-1)
 
         all_msgs = Variable(torch.zeros(pre_msg.size(0), pre_msg.size(1),
@@ -493,8 +509,7 @@ class RNNDecoder_multi(nn.Module):
             msg = msg * rel_type[:, :, i:i + 1]
             all_msgs += msg
 
-        agg_msgs = all_msgs.transpose(-2, -1).matmul(rel_rec).transpose(-2, -1)
-        agg_msgs = agg_msgs.contiguous()
+        agg_msgs = edge2node_scatter(all_msgs, rel_rec, inputs.size(1))
 
         if self.cond_msgs:
             cln_emb = self.clinical2msg_mlp(clinical_data)
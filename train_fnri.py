@@ -19,6 +19,10 @@ def parse_args(args):
                         help='Random seed (0 is no random-seed).')
     parser.add_argument('--no-cuda', action='store_true', default=False,
                         help='Disables CUDA training.')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='Compiles encoder and decoder (CUDA only).')
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='Runs forward pass and losses with bf16 autocast.')
 
     # Data arguments
     parser.add_argument('--data-folder', type=str, default='',
@@ -34,6 +38,8 @@ def parse_args(args):
                         help='The number of time steps per sample.')
     parser.add_argument('--dims-clinical', type=int, default=84,
                         help='Number of clinical features.')
+    parser.add_argument('--num-workers', type=int, default=2,
+                        help='Number of data loading workers.')
     # Training arguments
     parser.add_argument('--epochs', type=int, default=1,
                         help='Number of epochs to train.')
@@ -96,6 +102,9 @@ def parse_args(args):
                         help='KL-divergence beta factor')
     parser.add_argument('--mse-loss', action='store_true', default=False,
                         help='Use the MSE as the loss')
+    parser.add_argument('--kl-log-every', type=int, default=1,
+                        help=('Batches between logging the KL between blocks '
+                              '(0 never computes it).'))
 
     # Logger and Grapher arguments (using atalaya)
     # Logger
@@ -123,82 +132,88 @@ def parse_args(args):
     parser.add_argument('--visdom-password', type=str, default='',
                         help='Password of visdom server.')
 
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if args.kl_log_every < 0:
+        parser.error('--kl-log-every must be non-negative')
+    return args
 
 
 def run(mode, data_loader, encoder, decoder, optimizer, rel_rec,
         rel_send, log_prior, args):
+    # evaluation modes must not build an autograd graph, see test()
+    assert not torch.is_grad_enabled() or mode == 'train'
+
     history = {key: []
                for key in ['mse', 'nll', 'kl', 'loss', 'KLb_train', 'KLb_blocks']}
 
     if mode == 'post':
         aggr_posterior = torch.zeros((args.num_atoms**2)-args.num_atoms,
-                                     args.edge_types).to(args.device)
-        n_samples = 0
-
-    for batch_idx, (data, clinical) in enumerate(data_loader):
-        data = data.to(args.device)
-        if args.conditional:
-            clinical = clinical.to(args.device)
-
+                                     args.edge_types, device=args.device)
+        n_samples = len(data_loader.dataset)
+
+    # per batch metrics are kept on the device and copied back once per epoch
+    metric_keys = ['loss', 'mse', 'nll', 'kl']
+    metrics_buf = torch.empty((len(data_loader), len(metric_keys)),
+                              device=args.device)
+    KLb_blocks_buf = []
+
+    batches = prefetch_batches(data_loader, args.device,
+                               move_clinical=args.conditional)
+    for batch_idx, (data, clinical) in enumerate(batches):
         if mode == 'train':
-            optimizer.zero_grad()
-
-        logits = encoder(data, rel_rec, rel_send)
-
-        logits_split = torch.split(logits, args.edge_types_list, dim=-1)
-        edges_split = tuple([gumbel_softmax(logits_i, tau=args.temp, hard=args.hard)
-                             for logits_i in logits_split])
-
-        edges = torch.cat(edges_split, dim=-1)
+            optimizer.zero_grad(set_to_none=True)
 
-        prob_split = [my_softmax(logits_i, -1) for logits_i in logits_split]
+        with torch.autocast(device_type=args.device.type,
+                            dtype=torch.bfloat16, enabled=args.amp):
+            # logits are kept in FP32 for the softmax and KL terms
+            logits = encoder(data, rel_rec, rel_send).float()
 
-        if args.prior:
-            loss_kl_split = [kl_categorical(prob_split[type_idx], log_prior[type_idx], args.num_atoms)
-                             for type_idx in range(len(args.edge_types_list))]
-            loss_kl = sum(loss_kl_split)
-        else:
-            loss_kl_split = [kl_categorical_uniform(prob_split[type_idx], args.num_atoms,
-                                                    args.edge_types_list[type_idx])
-                             for type_idx in range(len(args.edge_types_list))]
-            loss_kl = sum(loss_kl_split)
+            edges, prob = gumbel_softmax_grouped(logits, args.edge_types_list,
+                                                 args.edge_types_seg,
+                                                 tau=args.temp, hard=args.hard)
+            prob_split = torch.split(prob, args.edge_types_list, dim=-1)
 
-            loss_kl_var_split = [kl_categorical_uniform_var(prob_split[type_idx], args.num_atoms,
-                                                            args.edge_types_list[type_idx])
-                                 for type_idx in range(len(args.edge_types_list))]
+            loss_kl_split = kl_categorical_grouped(
+                prob, log_prior, args.edge_types_seg,
+                len(args.edge_types_list), args.num_atoms)
+            loss_kl = loss_kl_split.sum()
 
-        KLb_blocks = KL_between_blocks(prob_split, args.num_atoms)
-        history['KLb_train'].append(sum(KLb_blocks).data.item())
-        history['KLb_blocks'].append([KL.data.item() for KL in KLb_blocks])
+            # between-block KL is only logged, every kl_log_every batches
+            if args.kl_log_every and batch_idx % args.kl_log_every == 0:
+                with torch.no_grad():
+                    KLb_blocks_buf.append(
+                        KL_between_blocks(prob_split, args.num_atoms))
 
-        output = decoder(data, edges, rel_rec, rel_send, clinical)
-
-        loss_nll = nll_gaussian(output, data, args.var)
-        loss_nll_var = nll_gaussian_var(output, data, args.var)
+            output = decoder(data, edges, rel_rec, rel_send, clinical)
 
-        # args.beta = int((loss_nll/loss_kl) / 10)
-        if not np.isclose(args.beta, 0, rtol=1e-6):
-            loss_kl = args.beta*loss_kl
+            loss_nll, loss_nll_var, loss_mse = nll_gaussian_mse(output, data,
+                                                                args.var)
 
-        loss_mse = F.mse_loss(output, data)
+            # args.beta = int((loss_nll/loss_kl) / 10)
+            if not np.isclose(args.beta, 0, rtol=1e-6):
+                loss_kl = args.beta*loss_kl
 
-        # if mse_loss == true use it else use elbo
-        loss = loss_mse if args.mse_loss else loss_nll + loss_kl
+            # if mse_loss == true use it else use elbo
+            loss = loss_mse if args.mse_loss else loss_nll + loss_kl
 
         if mode == 'train':
             loss.backward()
-            nn.utils.clip_grad_norm_(
-                list(encoder.parameters()) + list(decoder.parameters()), 1.)
+            nn.utils.clip_grad_norm_(args.all_params, 1., foreach=True)
             optimizer.step()
         if mode == 'post':
-            aggr_posterior = aggr_posterior + edges.sum(0)
-            n_samples = n_samples + data.size(0)
+            aggr_posterior.add_(edges.sum(dim=0, dtype=torch.float32))
 
-        history['loss'].append(loss.item())
-        history['mse'].append(loss_mse.item())
-        history['nll'].append(loss_nll.item())
-        history['kl'].append(loss_kl.item())
+        metrics_buf[batch_idx] = torch.stack([loss.detach(),
+                                              loss_mse.detach(),
+                                              loss_nll.detach(),
+                                              loss_kl.detach()])
+
+    for key, values in zip(metric_keys, metrics_buf.cpu().t().tolist()):
+        history[key] = values
+    if KLb_blocks_buf:
+        KLb_blocks = torch.stack(KLb_blocks_buf).cpu()
+        history['KLb_train'] = KLb_blocks.sum(dim=1).tolist()
+        history['KLb_blocks'] = KLb_blocks.tolist()
 
     if mode == 'post':
         return None, aggr_posterior/n_samples
@@ -224,7 +239,7 @@ def test(mode, epoch, data_loader, encoder, decoder, rel_rec, rel_send,
     encoder.eval()
     decoder.eval()
 
-    with torch.no_grad():
+    with torch.inference_mode():
         history, aggr_posterior = run(mode, data_loader, encoder, decoder,
                                       None, rel_rec, rel_send,
                                       log_prior, args)
@@ -239,38 +254,46 @@ def test(mode, epoch, data_loader, encoder, decoder, rel_rec, rel_send,
 def generations(data_loader, decoder, rel_rec, rel_send, aggr_posterior,
                 first_frame_params, args, logger):
     decoder.eval()
-    aggr_posterior = aggr_posterior.cpu().detach().numpy()
+    # log-posterior of every edge type block, sampled with the Gumbel-max trick
+    log_posterior_split = torch.split(torch.log(aggr_posterior.detach()),
+                                      args.edge_types_list, dim=-1)
 
     path = os.path.join('Results', logger.name)
     os.makedirs(path, exist_ok=True)
-    outputs = []
+    # outputs are written batch by batch into the saved .npy file
+    outputs = np.lib.format.open_memmap(
+        os.path.join(path, 'output.npy'), mode='w+', dtype=np.float32,
+        shape=(len(data_loader.dataset), args.num_atoms, args.timesteps,
+               args.dims))
+    sample_idx = 0
     for batch_idx, (data, clinical) in enumerate(data_loader):
         params = data[:, :, 0, :].to(args.device)
         data = data.to(args.device)
         clinical = clinical.to(args.device)
-        edges = np.zeros((data.shape[0], rel_rec.shape[0], args.edge_types))
-        for bz in range(data.shape[0]):
-            for i in range(rel_rec.shape[0]):
-                for et in range(len(args.edge_types_list)):
-                    n = args.edge_types_list[et]
-                    idx = np.random.choice(n, 1,
-                                           p=aggr_posterior[i, et*n:(et+1)*n])
-                    edges[bz, i, (et*n)+idx] = 1
-
-        edges = Variable(torch.Tensor(edges)).to(args.device)
-        with torch.no_grad():
+        edges = torch.zeros((data.shape[0], rel_rec.shape[0], args.edge_types),
+                            device=args.device)
+        offset = 0
+        for n, log_p in zip(args.edge_types_list, log_posterior_split):
+            log_p = log_p.expand(data.shape[0], -1, -1)
+            gumbel = -torch.log(-torch.log(torch.rand_like(log_p)))
+            idx = (log_p + gumbel).argmax(-1)
+            edges[:, :, offset:offset+n] = F.one_hot(idx, n).float()
+            offset += n
+
+        with torch.inference_mode():
             output = decoder(data, edges, rel_rec, rel_send, clinical)
         del edges
         mse = F.mse_loss(output, data).item()
         logger.add_scalar('generation_mse', mse, batch_idx+1)
 
-        output = output.data.cpu().detach().numpy()
-        outputs.append(output)
+        outputs[sample_idx:sample_idx+output.size(0)] = \
+            output.detach().cpu().numpy()
+        sample_idx += output.size(0)
 
     logger.info("Saving data !")
 
     # np.save(os.path.join(path, 'history.npy'), np.concatenate(history, axis=0))
-    np.save(os.path.join(path, 'output.npy'), np.concatenate(outputs, axis=0))
+    outputs.flush()
 
 
 def main(args):
@@ -309,19 +332,20 @@ def main(args):
 
     train_loader, val_loader, test_loader = load_data(args.batch_size,
                                                       args.data_folder,
-                                                      args.suffix)
+                                                      args.suffix,
+                                                      pin_memory=cuda,
+                                                      num_workers=args.num_workers)
 
     # get mean and std of the first frame on training samples
     first_frame_params = get_params_first_frame(train_loader)
 
     # Generate off-diagonal interaction graph
-    off_diag = np.ones([args.num_atoms, args.num_atoms]) \
-        - np.eye(args.num_atoms)
+    off_diag = torch.ones(args.num_atoms, args.num_atoms, device=args.device) \
+        - torch.eye(args.num_atoms, device=args.device)
 
-    rel_rec = np.array(encode_onehot(np.where(off_diag)[1]), dtype=np.float32)
-    rel_send = np.array(encode_onehot(np.where(off_diag)[0]), dtype=np.float32)
-    rel_rec = torch.FloatTensor(rel_rec)
-    rel_send = torch.FloatTensor(rel_send)
+    # receiver and sender node of every edge, used as gather/scatter indices
+    # instead of dense one-hot matrices
+    rel_send, rel_rec = off_diag.nonzero(as_tuple=True)
 
     args.edge_types_list = list(map(int, args.edge_types_list))
     args.edge_types_list.sort(reverse=True)
@@ -330,6 +354,14 @@ def main(args):
     else:
         raise ValueError('Could not compute the edge-types-list')
 
+    # edge type block of every column of the encoder logits
+    args.edge_types_seg = segment_ids(args.edge_types_list, args.device)
+
+    # log of the uniform prior of every edge type, shape [1, 1, sum(K)]
+    args.uniform_log_prior = torch.cat(
+        [torch.full((1, 1, k), -np.log(k), device=args.device)
+         for k in args.edge_types_list], dim=-1)
+
     # initialize encoder
     encoder = MLPEncoder_multi(args.timesteps * args.dims,
                                args.encoder_hidden,
@@ -354,10 +386,14 @@ def main(args):
     # add decoder to logger, will save chekpoints and best
     logger.add('decoder', decoder)
 
-    # optimizer
-    optimizer = optim.Adam(list(encoder.parameters())
-                           + list(decoder.parameters()),
-                           lr=args.lr)
+    # parameters of both models, also used for gradient clipping in run
+    args.all_params = ([p for p in encoder.parameters()]
+                       + [p for p in decoder.parameters()])
+
+    # optimizer, fused kernel on CUDA and multi-tensor (foreach) one on CPU
+    optimizer = optim.Adam(args.all_params, lr=args.lr,
+                           fused=True if cuda else None,
+                           foreach=None if cuda else True)
     logger.add('optimizer', optimizer)
 
     # scheduler for adam
@@ -376,7 +412,8 @@ def main(args):
     if args.load_folder:
         logger.restore(args.load_folder)
 
-    log_prior = None
+    # log-prior of the KL term concatenated over the edge types, [1, 1, sum(K)]
+    log_prior = args.uniform_log_prior
     if args.prior:
         prior_et = np.zeros(args.edge_types_list[0])
         prior_et[0] = 0.9
@@ -387,19 +424,23 @@ def main(args):
         if not all(prior[i].size == args.edge_types_list[i] for i in range(len(args.edge_types_list))):
             raise ValueError('Prior is incompatable with the edge types list')
         logger.info("Using prior: "+str(prior))
-        log_prior = []
-        for i in range(len(args.edge_types_list)):
-            prior_i = prior[i]
-            log_prior_i = torch.FloatTensor(np.log(prior_i))
-            log_prior_i = torch.unsqueeze(log_prior_i, 0)
-            log_prior_i = torch.unsqueeze(log_prior_i, 0)
-            log_prior_i = Variable(log_prior_i).to(args.device)
-            log_prior.append(log_prior_i)
+        log_prior = torch.cat(
+            [torch.log(torch.as_tensor(prior_i, dtype=torch.float32,
+                                       device=args.device)).view(1, 1, -1)
+             for prior_i in prior], dim=-1)
 
     encoder.to(args.device)
     decoder.to(args.device)
-    rel_rec = Variable(rel_rec).to(args.device)
-    rel_send = Variable(rel_send).to(args.device)
+
+    # compiled modules share the parameters of the ones added to the logger,
+    # the eager ones are kept for the aggregated posterior and generations
+    encoder_train, decoder_train = encoder, decoder
+    if args.compile and cuda:
+        torch.set_float32_matmul_precision('high')
+        encoder_train = torch.compile(encoder, mode='reduce-overhead',
+                                      fullgraph=False)
+        decoder_train = torch.compile(decoder, mode='reduce-overhead',
+                                      fullgraph=False)
 
     # check if the nri will be cond
     args.conditional = (args.cond_hidden or args.cond_msgs)
@@ -407,14 +448,15 @@ def main(args):
     # Train model
     stop_early = 0
     for epoch in range(1, args.epochs+1):
-        _ = train(epoch, train_loader, encoder, decoder, optimizer, scheduler,
-                  rel_rec, rel_send, log_prior, args, logger)
+        _ = train(epoch, train_loader, encoder_train, decoder_train, optimizer,
+                  scheduler, rel_rec, rel_send, log_prior, args, logger)
 
-        val_loss, _ = test('val', epoch, val_loader, encoder, decoder, rel_rec,
-                           rel_send, log_prior, args, logger)
+        val_loss, _ = test('val', epoch, val_loader, encoder_train,
+                           decoder_train, rel_rec, rel_send, log_prior, args,
+                           logger)
 
-        _, _ = test('test', epoch, test_loader, encoder, decoder, rel_rec,
-                    rel_send, log_prior, args, logger)
+        _, _ = test('test', epoch, test_loader, encoder_train, decoder_train,
+                    rel_rec, rel_send, log_prior, args, logger)
 
         # store a checkpoint and save if val_loss < min(all previous val_loss)
         best_val_loss = logger.store(val_loss)
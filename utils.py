@@ -1,4 +1,6 @@
 import os
+from typing import Tuple
+
 import numpy as np
 import torch
 from torch.utils.data.dataset import TensorDataset
@@ -109,13 +111,74 @@ def gumbel_softmax(logits, tau=1, hard=False, eps=1e-10):
     return y
 
 
+def segment_ids(edge_types_list, device=None):
+    """Index of the edge type block of every column of the concatenated
+    logits, e.g. [2, 3] -> [0, 0, 1, 1, 1]."""
+    return torch.repeat_interleave(
+        torch.arange(len(edge_types_list), device=device),
+        torch.tensor(edge_types_list, device=device))
+
+
+def segment_max(input, seg_ids, num_segments):
+    """Max over the last dimension of input within every segment, gathered
+    back to the shape of input."""
+    index = seg_ids.expand_as(input)
+    seg_max = input.new_full(input.shape[:-1] + (num_segments,),
+                             float('-inf'))
+    seg_max = seg_max.scatter_reduce(-1, index, input, reduce='amax')
+    return seg_max.gather(-1, index)
+
+
+def segment_softmax(input, seg_ids, num_segments):
+    """Softmax over the last dimension of input, normalized independently
+    within every segment given by seg_ids."""
+    index = seg_ids.expand_as(input)
+    exp = torch.exp(input - segment_max(input.detach(), seg_ids,
+                                        num_segments))
+    seg_sum = exp.new_zeros(input.shape[:-1] + (num_segments,))
+    seg_sum = seg_sum.scatter_add(-1, index, exp)
+    return exp / seg_sum.gather(-1, index)
+
+
+def gumbel_softmax_grouped(logits, edge_types_list, seg_ids, tau=1,
+                           hard=False):
+    """
+    Gumbel-Softmax over the concatenated logits of several edge type blocks.
+
+    Equivalent to splitting logits by edge_types_list, calling gumbel_softmax
+    on every block and concatenating the results, but with a single noise
+    tensor and a segmented softmax over the whole logits.
+    Args:
+      logits: [..., sum(edge_types_list)] unnormalized log-probs
+      edge_types_list: number of edge types of every block
+      seg_ids: output of segment_ids(edge_types_list)
+      tau: non-negative scalar temperature
+      hard: if True, take argmax of every block, but differentiate w.r.t.
+        soft sample y
+    Returns:
+      the sample and the (noiseless) probabilities of every block, so callers
+      do not need a second softmax over logits
+    """
+    num_segments = len(edge_types_list)
+    prob = segment_softmax(logits, seg_ids, num_segments)
+    gumbels = -torch.empty_like(logits).exponential_().log()
+    y = (logits + gumbels) / tau
+    y_soft = segment_softmax(y, seg_ids, num_segments)
+    if hard:
+        y = y.detach()
+        y_hard = (y == segment_max(y, seg_ids, num_segments)).to(y_soft)
+        return y_hard - y_soft.detach() + y_soft, prob
+    return y_soft, prob
+
+
 def binary_accuracy(output, labels):
     preds = output > 0.5
     correct = preds.type_as(labels).eq(labels).double()
     correct = correct.sum()
     return correct / len(labels)
 
-def load_data(batch_size=1, data_folder='', suffix=''):
+def load_data(batch_size=1, data_folder='', suffix='', pin_memory=False,
+              num_workers=0):
     feat_train = np.load(os.path.join(data_folder, suffix,
                                       'motion_train_{}.npy'.format(suffix)))
     feat_valid = np.load(os.path.join(data_folder, suffix,
@@ -157,12 +220,57 @@ def load_data(batch_size=1, data_folder='', suffix=''):
     valid_data = TensorDataset(feat_valid, clinical_valid)
     test_data = TensorDataset(feat_test, clinical_test)
 
-    train_data_loader = DataLoader(train_data, batch_size=batch_size)
-    valid_data_loader = DataLoader(valid_data, batch_size=batch_size)
-    test_data_loader = DataLoader(test_data, batch_size=batch_size)
+    loader_kwargs = {'batch_size': batch_size, 'pin_memory': pin_memory,
+                     'num_workers': num_workers}
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
+
+    train_data_loader = DataLoader(train_data, **loader_kwargs)
+    valid_data_loader = DataLoader(valid_data, **loader_kwargs)
+    test_data_loader = DataLoader(test_data, **loader_kwargs)
 
     return train_data_loader, valid_data_loader, test_data_loader
 
+
+def prefetch_batches(data_loader, device, move_clinical=True):
+    """Iterates over the (data, clinical) batches of data_loader moved to
+    device. On CUDA the next batch is copied on a side stream while the
+    current one is being used."""
+    if device.type != 'cuda':
+        for data, clinical in data_loader:
+            yield data.to(device), (clinical.to(device) if move_clinical
+                                    else clinical)
+        return
+
+    stream = torch.cuda.Stream(device)
+
+    def to_device(batch):
+        data, clinical = batch
+        with torch.cuda.stream(stream):
+            data = data.to(device, non_blocking=True)
+            if move_clinical:
+                clinical = clinical.to(device, non_blocking=True)
+        return data, clinical
+
+    def wait(batch):
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_stream(stream)
+        for tensor in batch:
+            if tensor.is_cuda:
+                tensor.record_stream(current_stream)
+        return batch
+
+    loader_iter = iter(data_loader)
+    try:
+        next_batch = to_device(next(loader_iter))
+    except StopIteration:
+        return
+    for batch in loader_iter:
+        current_batch = wait(next_batch)
+        next_batch = to_device(batch)
+        yield current_batch
+    yield wait(next_batch)
+
 def load_skeleton(data_folder='', suffix=''):
     skeleton = np.load(os.path.join(data_folder, suffix,
                        'skeleton_{}.npy'.format(suffix)))
@@ -297,6 +405,7 @@ def get_correct_per_bucket_(bucket_idx, pred, target):
 
 
 def kl_categorical(preds, log_prior, num_atoms, eps=1e-16):
+    preds = preds.float()
     kl_div = preds * (torch.log(preds + eps) - log_prior)
     return kl_div.sum() / (num_atoms * preds.size(0))
 
@@ -317,17 +426,37 @@ def kl_categorical_uniform_var(preds, num_atoms, num_edge_types, add_const=False
         kl_div += const
     return (kl_div.sum(dim=1) / num_atoms).var() 
 
+@torch.jit.script
+def kl_categorical_grouped(preds: torch.Tensor, log_prior: torch.Tensor,
+                           seg_ids: torch.Tensor, num_segments: int,
+                           num_atoms: int, eps: float = 1e-16) -> torch.Tensor:
+    # kl_categorical of every edge type block of the concatenated preds
+    preds = preds.float()
+    kl_div = preds * (torch.log(preds + eps) - log_prior)
+    kl_div = kl_div.reshape(-1, kl_div.size(-1)).sum(0)
+    kl_div = kl_div.new_zeros(num_segments).index_add_(0, seg_ids, kl_div)
+    return kl_div / (num_atoms * preds.size(0))
+
 def KL_between_blocks(prob_list, num_atoms, eps=1e-16):
-    # Return a list of the mutual information between every block pair
-    KL_list = []
-    for i in range(len(prob_list)):
-        for j in range(len(prob_list)):
-            if i != j:
-                KL = prob_list[i] *( torch.log(prob_list[i] + eps) - torch.log(prob_list[j] + eps) )
-                KL_list.append( KL.sum() / (num_atoms * prob_list[i].size(0)) )
-                KL = prob_list[i] *( torch.log(prob_list[i] + eps) - torch.log( true_flip(prob_list[j],-1) + eps) )
-                KL_list.append( KL.sum() / (num_atoms * prob_list[i].size(0)) )  
-    return KL_list
+    # Return the KL divergence between every block pair (i, j), i != j, and
+    # between block i and the flipped block j, as a [2 * n * (n - 1)] tensor.
+    # Blocks are zero padded to the largest number of edge types and stacked
+    # to compute all the pairs at once.
+    k_max = max(prob.size(-1) for prob in prob_list)
+    prob = torch.stack([F.pad(p.float(), (0, k_max - p.size(-1)))
+                        for p in prob_list])
+    prob_flip = torch.stack([F.pad(true_flip(p.float(), -1),
+                                   (0, k_max - p.size(-1)))
+                             for p in prob_list])
+    entropy = (prob * torch.log(prob + eps)).sum((1, 2, 3))
+    # keep the pairwise products in FP32 when called under autocast
+    with torch.autocast(device_type=prob.device.type, enabled=False):
+        cross = torch.einsum('ibek,jbek->ij', prob, torch.log(prob + eps))
+        cross_flip = torch.einsum('ibek,jbek->ij', prob,
+                                  torch.log(prob_flip + eps))
+    KL = entropy[:, None, None] - torch.stack((cross, cross_flip), dim=-1)
+    off_diag = ~torch.eye(len(prob_list), dtype=torch.bool, device=KL.device)
+    return KL[off_diag].reshape(-1) / (num_atoms * prob.size(1))
 
 def nll_gaussian(preds, target, variance, add_const=False):
     neg_log_p = ((preds - target) ** 2 / (2 * variance))
@@ -336,6 +465,17 @@ def nll_gaussian(preds, target, variance, add_const=False):
         neg_log_p += const
     return neg_log_p.sum() / (target.size(0) * target.size(1))
 
+@torch.jit.script
+def nll_gaussian_mse(preds: torch.Tensor, target: torch.Tensor,
+                     variance: float
+                     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # nll_gaussian, nll_gaussian_var and the MSE sharing one squared error
+    sq_err = (preds.float() - target.float()) ** 2
+    neg_log_p = sq_err / (2 * variance)
+    nll = neg_log_p.sum() / (target.size(0) * target.size(1))
+    nll_var = (neg_log_p.sum(dim=1) / target.size(1)).var()
+    return nll, nll_var, sq_err.mean()
+
 def nll_gaussian_var(preds, target, variance, add_const=False):
     # returns the variance over the batch of the reconstruction loss
     neg_log_p = ((preds - target) ** 2 / (2 * variance))